@@ -2,10 +2,15 @@
 #  SPDX-License-Identifier: Apache-2.0
 import json
 import sys
+import urllib.parse
+from logging import DEBUG
+from typing import Dict
 from typing import List
+from typing import Optional
+from typing import Tuple
+from typing import TYPE_CHECKING
 
 import aria.ops.adapter_logging as logging
-from aria.ops.adapter_instance import AdapterInstance
 from aria.ops.data import Metric
 from aria.ops.definition.adapter_definition import AdapterDefinition
 from aria.ops.result import CollectResult
@@ -14,10 +19,36 @@ from aria.ops.result import TestResult
 from aria.ops.timer import Timer
 from constants import ADAPTER_KIND
 from constants import ADAPTER_NAME
-import requests
+from constants import CONNECT_TIMEOUT
+from constants import READ_TIMEOUT
+
+# The HTTP client (also pulled in by AdapterInstance) is only needed by the methods that take an
+# adapter instance, so it is imported lazily to keep 'adapter_definition' from paying for it at
+# startup.
+if TYPE_CHECKING:
+    import requests
+    from aria.ops.adapter_instance import AdapterInstance
 
 logger = logging.getLogger(__name__)
 
+# A single session is shared by all calls made from this process, so the TCP/TLS connection to
+# the market API is kept alive and reused instead of being renegotiated on every request.
+_SESSION: Optional["requests.Session"] = None
+
+# The adapter definition only depends on constants, so it is built once per process.
+_DEF_CACHE: Optional[AdapterDefinition] = None
+
+# Set once logging has been configured for this process.
+_LOG_READY = False
+
+# Prepared market API requests, keyed by (ticker, api_key).
+_PREPARED: Dict[Tuple[str, str], "requests.PreparedRequest"] = {}
+
+# ETag and decoded body of the last successful quote, keyed by (ticker, api_key), used for
+# conditional requests. These only take effect when several calls are served by the same process.
+_ETAG: Dict[Tuple[str, str], str] = {}
+_LAST: Dict[Tuple[str, str], dict] = {}
+
 
 def get_adapter_definition() -> AdapterDefinition:
     """
@@ -26,6 +57,9 @@ def get_adapter_definition() -> AdapterDefinition:
     validate, process, and display the data correctly.
     :return: AdapterDefinition
     """
+    global _DEF_CACHE
+    if _DEF_CACHE is not None:
+        return _DEF_CACHE
     try:
         with Timer(logger, "Get Adapter Definition"):
             definition = AdapterDefinition(ADAPTER_KIND, ADAPTER_NAME)
@@ -60,12 +94,101 @@ def get_adapter_definition() -> AdapterDefinition:
             quote = definition.define_object_type("quote", "Quote")
             quote.define_metric("bid", "bid", None)
             quote.define_metric("ask", "ask", None)
+            _DEF_CACHE = definition
             return definition
     except Exception as e:
         logger.error(e)
 
 
-def test(adapter_instance: AdapterInstance) -> TestResult:
+def _get_session() -> "requests.Session":
+    """
+    Returns the shared HTTP session, creating it on first use.
+    :return: Session
+    """
+    global _SESSION
+    if _SESSION is None:
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        _SESSION = requests.Session()
+        _SESSION.mount(
+            "https://",
+            HTTPAdapter(
+                pool_connections=2,
+                pool_maxsize=4,
+                max_retries=Retry(total=2, backoff_factor=0.2, status_forcelist=[502, 503, 504]),
+            ),
+        )
+    return _SESSION
+
+
+def _quote_url(ticker: str, api_key: str) -> str:
+    """
+    Builds the last-quote URL for the given ticker, escaping both values.
+    :return: The request URL
+    """
+    ticker = urllib.parse.quote(ticker, safe="")
+    api_key = urllib.parse.quote(api_key, safe="")
+    return f"https://api.finage.co.uk/last/stock/{ticker}?apikey={api_key}"
+
+
+def _prepare(ticker: str, api_key: str) -> "requests.PreparedRequest":
+    """
+    Returns the prepared last-quote request for the given ticker, building it on first use.
+    :return: PreparedRequest
+    """
+    key = (ticker, api_key)
+    prepared = _PREPARED.get(key)
+    if prepared is None:
+        import requests
+
+        request = requests.Request("GET", _quote_url(ticker, api_key))
+        prepared = _PREPARED[key] = _get_session().prepare_request(request)
+    return prepared
+
+
+def _send(prepared: "requests.PreparedRequest", stream: bool = False) -> "requests.Response":
+    """
+    Sends a prepared request through the shared session. Session.send() does not apply the
+    environment settings (proxies, REQUESTS_CA_BUNDLE, CURL_CA_BUNDLE) that Session.get() would,
+    so they are merged in explicitly.
+    :return: Response
+    """
+    session = _get_session()
+    settings = session.merge_environment_settings(prepared.url, {}, stream, None, None)
+    return session.send(prepared, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT), **settings)
+
+
+def _get_quote(ticker: str, api_key: str) -> dict:
+    """
+    Fetches the last quote for a single ticker from the market API. If the quote has not changed
+    since the previous call, the previously decoded quote is returned.
+    :return: The decoded JSON quote
+    """
+    import orjson
+
+    key = (ticker, api_key)
+    prepared = _prepare(ticker, api_key)
+    etag = _ETAG.get(key)
+    if etag:
+        prepared = prepared.copy()
+        prepared.headers["If-None-Match"] = etag
+    response = _send(prepared)
+    if response.status_code == 304 and key in _LAST:
+        return _LAST[key]
+    response.raise_for_status()
+    q = orjson.loads(response.content)
+    etag = response.headers.get("ETag")
+    if response.status_code == 200 and etag:
+        _ETAG[key] = etag
+        _LAST[key] = q
+    return q
+
+
+def test(adapter_instance: "AdapterInstance") -> TestResult:
+    import requests
+
     with Timer(logger, "Test"):
         result = TestResult()
         try:
@@ -82,20 +205,32 @@ def test(adapter_instance: AdapterInstance) -> TestResult:
             # connection test.
             ticker = adapter_instance.get_identifier_value("ticker")
             api_key = adapter_instance.get_credential_value("apiKey")
-            response = requests.get(f"https://api.finage.co.uk/last/stock/{ticker}?apikey={api_key}")
-            if response.status_code != 200:
-                result.with_error("Error connecting to market")
-        except Exception as e:
+            if not ticker or not api_key:
+                result.with_error("Ticker and API key must be set")
+            else:
+                # Only the status code matters here, so the response is streamed and closed without
+                # downloading the body. Each command runs in its own process, so there is no later
+                # request that could reuse the connection.
+                response = _send(_prepare(ticker, api_key), stream=True)
+                response.close()
+                if response.status_code != 200:
+                    result.with_error("Error connecting to market")
+        except requests.exceptions.RetryError:
+            # The session retries 5xx responses and raises once the retries are exhausted.
+            result.with_error("Error connecting to market")
+        except requests.RequestException as e:
             logger.error("Unexpected connection test error")
             logger.exception(e)
             result.with_error("Unexpected connection test error: " + repr(e))
-        finally:
-            # TODO: If any connections are still open, make sure they are closed before returning
-            logger.debug(f"Returning test result: {result.get_json()}")
-            return result
+        # TODO: If any connections are still open, make sure they are closed before returning
+        if logger.isEnabledFor(DEBUG):
+            logger.debug("Returning test result: %s", result.get_json())
+        return result
+
 
+def collect(adapter_instance: "AdapterInstance") -> CollectResult:
+    import requests
 
-def collect(adapter_instance: AdapterInstance) -> CollectResult:
     with Timer(logger, "Collection"):
         result = CollectResult()
         try:
@@ -112,30 +247,31 @@ def collect(adapter_instance: AdapterInstance) -> CollectResult:
             # Collect the API key and ticker symbol
             ticker = adapter_instance.get_identifier_value("ticker")
             api_key = adapter_instance.get_credential_value("apiKey")
+            if not ticker or not api_key:
+                result.with_error("Ticker and API key must be set")
+            else:
+                # Call the market API
+                q = _get_quote(ticker, api_key)
 
-            # Call the market API
-            q = requests.get(f"https://api.finage.co.uk/last/stock/{ticker}?apikey={api_key}").json()
-
-            # Create an instance of the Quote object and give it the name of the ticker. The resource will
-            # be automatically created in VCF Ops if it didn't already exist.
-            quote = result.object(ADAPTER_KIND, "Quote", ticker)
-            bid = Metric("bid", q["bid"])
-            ask = Metric("ask", q["ask"])
+                # Create an instance of the Quote object and give it the name of the ticker. The resource will
+                # be automatically created in VCF Ops if it didn't already exist.
+                quote = result.object(ADAPTER_KIND, "Quote", ticker)
 
-            # Add the bid and ask price to the resource.
-            quote.add_metric(bid)
-            quote.add_metric(ask)
-        except Exception as e:
+                # Add the bid and ask price to the resource.
+                quote.add_metrics([Metric(name, q[name]) for name in ("bid", "ask")])
+        except (requests.RequestException, KeyError, TypeError, ValueError) as e:
+            # RequestException covers connection, timeout, HTTP status and body read errors,
+            # ValueError a malformed JSON body, and KeyError/TypeError a body that is not a quote.
             logger.error("Unexpected collection error")
             logger.exception(e)
             result.with_error("Unexpected collection error: " + repr(e))
-        finally:
-            # TODO: If any connections are still open, make sure they are closed before returning
-            logger.debug(f"Returning collection result {result.get_json()}")
-            return result
+        # TODO: If any connections are still open, make sure they are closed before returning
+        if logger.isEnabledFor(DEBUG):
+            logger.debug("Returning collection result %s", result.get_json())
+        return result
 
 
-def get_endpoints(adapter_instance: AdapterInstance) -> EndpointResult:
+def get_endpoints(adapter_instance: "AdapterInstance") -> EndpointResult:
     with Timer(logger, "Get Endpoints"):
         result = EndpointResult()
         # In the case that an SSL Certificate is needed to communicate to the target,
@@ -157,49 +293,60 @@ def get_endpoints(adapter_instance: AdapterInstance) -> EndpointResult:
         # AdapterInstance object that is passed to the 'test' and 'collect' methods.
         # Any certificate that is encountered in those methods should then be validated
         # against the certificate(s) in the AdapterInstance.
-        logger.debug(f"Returning endpoints: {result.get_json()}")
+        if logger.isEnabledFor(DEBUG):
+            logger.debug("Returning endpoints: %s", result.get_json())
         return result
 
 
+# Methods that take an adapter instance as input, keyed by the method name passed by the server.
+_DISPATCH = {
+    "test": test,
+    "endpoint_urls": get_endpoints,
+    "collect": collect,
+}
+
+
 # Main entry point of the adapter. You should not need to modify anything below this line.
-def main(argv: List[str]) -> None:
-    logging.setup_logging("adapter.log")
-    # Start a new log file by calling 'rotate'. By default, the last five calls will be
-    # retained. If the logs are not manually rotated, the 'setup_logging' call should be
-    # invoked with the 'max_size' parameter set to a reasonable value, e.g.,
-    # 10_489_760 (10MB).
-    logging.rotate()
-    logger.info(f"Running adapter code with arguments: {argv}")
+def main(argv: List[str]) -> int:
+    global _LOG_READY
+    if not _LOG_READY:
+        # Logging is set up, and a new log file started with 'rotate', once per process. Files
+        # also roll over when they reach 'max_size' (10MB). Both kinds of rollover share the
+        # five backup files, so the logs hold the current file plus the last five rolled-over
+        # files, whether those came from a new process or from a full file.
+        logging.setup_logging("adapter.log", max_size=10_485_760)
+        logging.rotate()
+        _LOG_READY = True
+    logger.info("Running adapter code with arguments: %s", argv, extra={"argv": argv})
     if len(argv) != 3:
         # `inputfile` and `outputfile` are always automatically appended to the
         # argument list by the server
         logger.error("Arguments must be <method> <inputfile> <ouputfile>")
-        sys.exit(1)
+        return 1
 
     method = argv[0]
     try:
-        if method == "test":
-            test(AdapterInstance.from_input()).send_results()
-        elif method == "endpoint_urls":
-            get_endpoints(AdapterInstance.from_input()).send_results()
-        elif method == "collect":
-            collect(AdapterInstance.from_input()).send_results()
+        handler = _DISPATCH.get(method)
+        if handler:
+            from aria.ops.adapter_instance import AdapterInstance
+
+            handler(AdapterInstance.from_input()).send_results()
         elif method == "adapter_definition":
             result = get_adapter_definition()
-            if type(result) is AdapterDefinition:
+            if isinstance(result, AdapterDefinition):
                 result.send_results()
             else:
                 logger.info(
                     "get_adapter_definition method did not return an AdapterDefinition"
                 )
-                sys.exit(1)
+                return 1
         else:
-            logger.error(f"Command {method} not found")
-            sys.exit(1)
+            logger.error("Command %s not found", method, extra={"method": method})
+            return 1
     finally:
         logger.info(Timer.graph())
-        sys.exit(0)
+    return 0
 
 
 if __name__ == "__main__":
-    main(sys.argv[1:])
+    sys.exit(main(sys.argv[1:]))
@@ -1,2 +1,7 @@
 ADAPTER_KIND = "StockQuote"
 ADAPTER_NAME = "Stock Quote"
+
+# Timeouts in seconds for connecting to and reading from the market API. Bounding them keeps a
+# stalled connection from blocking the collector indefinitely.
+CONNECT_TIMEOUT = 3.05
+READ_TIMEOUT = 10